@@ -16,6 +16,7 @@ at runtime.
 import argparse
 import os
 from .manifest_components.manifest import RuntimeType
+from .model_packaging_utils import DEFAULT_COMPRESS_LEVEL
 
 
 # noinspection PyTypeChecker
@@ -87,6 +88,18 @@ class ArgParser(object):
                                         ' This is the default archiving format. Models archived in this format'
                                         ' will be readily hostable on native MMS.\n')
 
+        parser_export.add_argument('--compress-level',
+                                   required=False,
+                                   type=int,
+                                   default=DEFAULT_COMPRESS_LEVEL,
+                                   choices=range(10),
+                                   metavar='{0-9}',
+                                   help='Compression level used for the model-archive, from 0 (no compression, '
+                                        'fastest) to 9 (smallest archive, slowest). The default level is '
+                                        '{}. In the default format, files that barely compress, such as most .params '
+                                        'files, are stored as is below level 6. From level 6 on only files that '
+                                        'would not shrink at all are stored.'.format(DEFAULT_COMPRESS_LEVEL))
+
         parser_export.add_argument('-f', '--force',
                                    required=False,
                                    action='store_true',
@@ -0,0 +1,45 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+"""
+JSON helpers for the manifest and signature files. orjson is used when it is installed, the standard library
+json module otherwise. Both write non-ASCII characters as is rather than as \\u escapes, so the output is the
+same text whichever backend is used and has to be written out as UTF-8.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """
+    Serialize obj to a JSON string indented by two spaces
+    :param obj:
+    :return:
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode('utf-8')
+    # ensure_ascii=False to match orjson, which has no option to escape non-ASCII characters
+    s = json.dumps(obj, indent=2, ensure_ascii=False)
+    return s.decode('utf-8') if isinstance(s, bytes) else s
+
+
+def loads(s):
+    """
+    Deserialize a JSON document
+    :param s:
+    :return:
+    """
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
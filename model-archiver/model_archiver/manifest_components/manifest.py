@@ -10,8 +10,8 @@
 
 # pylint: disable=redefined-builtin
 # pylint: disable=missing-docstring
-import json
 from enum import Enum
+from .. import json_utils
 
 
 class RuntimeType(Enum):
@@ -77,7 +77,9 @@ class Manifest(object):
         return manifest_dict
 
     def __str__(self):
-        return json.dumps(self.manifest_dict, indent=2)
+        manifest_json = json_utils.dumps(self.manifest_dict)
+        # str() has to return a byte string on Python 2
+        return manifest_json if isinstance(manifest_json, str) else manifest_json.encode('utf-8')
 
     def __repr__(self):
-        return json.dumps(self.manifest_dict, indent=2)
+        return self.__str__()
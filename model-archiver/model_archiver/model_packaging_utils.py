@@ -12,11 +12,25 @@
 Helper utils for Model Export tool
 """
 
-import json
+import errno
+import io
 import logging
 import os
 import re
+import shutil
+import sys
+import time
 import zipfile
+import zlib
+try:
+    from os import scandir
+except ImportError:  # Python 2.7
+    from scandir import scandir
+try:
+    from shutil import which
+except ImportError:  # Python 2.7
+    from distutils.spawn import find_executable as which
+from . import json_utils
 from .model_archiver_error import ModelArchiverError
 
 from .manifest_components.engine import Engine
@@ -31,6 +45,24 @@ MODEL_ARCHIVE_VERSION = '1.0'
 MANIFEST_FILE_NAME = 'MANIFEST.json'
 MAR_INF = 'MAR-INF'
 ONNX_TYPE = '.onnx'
+EXCLUDED_FILE_SUFFIXES = ('.pyc', '.DS_Store', MODEL_ARCHIVE_EXTENSION)
+UNWANTED_DIRS = frozenset({'__MACOSX', '__pycache__'})
+# Command line arguments that make up the manifest
+MANIFEST_ARGS = ('runtime', 'model_name', 'handler', 'engine', 'author', 'email')
+MANIFEST_CACHE_SIZE = 128
+DEFAULT_COMPRESS_LEVEL = 1
+# \Z rather than $, which would also accept a trailing newline
+MODEL_NAME_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_\-.]*\Z')
+LARGE_FILE_SIZE = 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+# Below HIGH_COMPRESS_LEVEL, files whose first INCOMPRESSIBLE_PROBE_SIZE bytes deflate to more than
+# INCOMPRESSIBLE_RATIO of their size, such as most .params files, are stored uncompressed. From HIGH_COMPRESS_LEVEL
+# on the smallest archive is wanted, so only files that deflate would not shrink at all are stored.
+INCOMPRESSIBLE_PROBE_SIZE = 64 * 1024
+INCOMPRESSIBLE_RATIO = 0.9
+HIGH_COMPRESS_LEVEL = 6
+# ZipFile.open only supports writing from Python 3.6 onwards
+ZIP_OPEN_FOR_WRITE_SUPPORTED = sys.version_info >= (3, 6)
 
 
 class ModelExportUtils(object):
@@ -39,6 +71,9 @@ class ModelExportUtils(object):
     This class lists out all the methods such as validations for model archiving, ONNX model checking etc.
     """
 
+    # Serialized manifests keyed by the MANIFEST_ARGS they were generated from
+    manifest_cache = {}
+
     @staticmethod
     def get_archive_export_path(export_file_path, model_name, archive_format):
         return os.path.join(export_file_path, '{}{}'.format(model_name,
@@ -54,23 +89,30 @@ class ModelExportUtils(object):
         :param model_name:
         :param export_file_path:
         :param overwrite:
-        :return:
+        :return: path of the model-archive file to write
         """
         if export_file_path is None:
             export_file_path = os.getcwd()
 
         export_file = ModelExportUtils.get_archive_export_path(export_file_path, model_name, archive_format)
 
-        if os.path.exists(export_file):
-            if overwrite:
-                logging.warning("Overwriting %s ...", export_file)
-            else:
-                raise ModelArchiverError("%s already exists.\n"
+        try:
+            os.stat(export_file)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            if not overwrite:
+                raise ModelArchiverError("{} already exists.\n"
                                          "Please specify --force/-f option to overwrite the model archive "
                                          "output file.\n"
-                                         "See -h/--help for more details." + export_file)
+                                         "See -h/--help for more details.".format(export_file))
+            # Fail now rather than after the model files have been converted and compressed
+            if not os.access(export_file, os.W_OK):
+                raise ModelArchiverError("{} already exists and is not writable.".format(export_file))
+            logging.warning("Overwriting %s ...", export_file)
 
-        return export_file_path
+        return export_file
 
     @staticmethod
     def check_custom_model_types(model_path, model_name=None):
@@ -84,8 +126,10 @@ class ModelExportUtils(object):
         temp_files = []  # List of temp files added to handle custom models
         files_to_exclude = []  # List of files to be excluded from .mar packaging.
 
-        files_set = set(os.listdir(model_path))
-        onnx_file = ModelExportUtils.find_unique(files_set, ONNX_TYPE)
+        # Single pass over the directory entries, skipping hidden files such as macOS '._model.onnx' metadata
+        onnx_files = [entry.name for entry in scandir(model_path)
+                      if entry.name.endswith(ONNX_TYPE) and not entry.name.startswith('.') and entry.is_file()]
+        onnx_file = ModelExportUtils.find_unique(onnx_files, ONNX_TYPE)
         if onnx_file is not None:
             logging.debug("Found ONNX files. Converting ONNX file to model archive...")
             symbol_file, params_file = ModelExportUtils.convert_onnx_model(model_path, onnx_file, model_name)
@@ -132,7 +176,8 @@ class ModelExportUtils(object):
             raise ModelArchiverError("MXNet package is not installed. Run command: pip install mxnet to install it.")
 
         try:
-            import onnx
+            # Only checked here so a missing package fails before any work is done, parse_onnx_model uses it
+            import onnx  # pylint: disable=unused-import
         except ImportError:
             raise ModelArchiverError("Onnx package is not installed. Run command: pip install onnx to install it.")
 
@@ -141,23 +186,16 @@ class ModelExportUtils(object):
         signature_file = 'signature.json'
         # Find input symbol name and shape
         try:
-            model_proto = onnx.load(os.path.join(model_path, onnx_file))
+            model_proto = ModelExportUtils.parse_onnx_model(os.path.join(model_path, onnx_file))
         except:
             logging.error("Failed to load the %s model. Verify if the model file is valid", onnx_file)
             raise
 
         graph = model_proto.graph
-        _params = set()
-        for tensor_vals in graph.initializer:
-            _params.add(tensor_vals.name)
-
-        input_data = []
-        for graph_input in graph.input:
-            shape = []
-            if graph_input.name not in _params:
-                for val in graph_input.type.tensor_type.shape.dim:
-                    shape.append(val.dim_value)
-                input_data.append((graph_input.name, tuple(shape)))
+        _params = {tensor_vals.name for tensor_vals in graph.initializer}
+
+        input_data = [(graph_input.name, tuple(val.dim_value for val in graph_input.type.tensor_type.shape.dim))
+                      for graph_input in graph.input if graph_input.name not in _params]
 
         try:
             sym, arg_params, aux_params = onnx_mxnet.import_model(os.path.join(model_path, onnx_file))
@@ -169,12 +207,13 @@ class ModelExportUtils(object):
 
         try:
             # rewrite input data_name correctly
-            with open(os.path.join(model_path, signature_file), 'r') as f:
-                data = json.loads(f.read())
+            with io.open(os.path.join(model_path, signature_file), 'r+', encoding='utf-8') as f:
+                data = json_utils.loads(f.read())
                 data['inputs'][0]['data_name'] = input_data[0][0]
                 data['inputs'][0]['data_shape'] = [int(i) for i in input_data[0][1]]
-            with open(os.path.join(model_path, signature_file), 'w') as f:
-                f.write(json.dumps(data, indent=2))
+                f.seek(0)
+                f.write(json_utils.dumps(data))
+                f.truncate()
 
             with open(os.path.join(model_path, symbol_file), 'w') as f:
                 f.write(sym.tojson())
@@ -182,10 +221,37 @@ class ModelExportUtils(object):
             logging.error("Failed to write the signature or symbol files for %s model", onnx_file)
             raise
 
-        save_dict = {('arg:%s' % k): v.as_in_context(mx.cpu()) for k, v in params.items()}
+        # import_model creates the parameters on the CPU and mx.nd.save copies from other contexts itself,
+        # so there is no need to move every tensor with as_in_context first
+        save_dict = {'arg:' + k: v for k, v in params.items()}
         mx.nd.save(os.path.join(model_path, params_file), save_dict)
         return symbol_file, params_file
 
+    @staticmethod
+    def parse_onnx_model(onnx_path):
+        """
+        Parse an ONNX model out of a read-only memory map of the file, instead of reading the whole protobuf
+        onto the heap like onnx.load does
+        :param onnx_path:
+        :return:
+        """
+        import mmap
+        from contextlib import closing
+        import onnx
+
+        model_proto = onnx.ModelProto()
+        with open(onnx_path, 'rb') as f, closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as m:
+            try:
+                view = memoryview(m)
+            except TypeError:  # Python 2.7 mmap does not export the buffer protocol
+                model_proto.ParseFromString(m[:])
+            else:
+                try:
+                    model_proto.ParseFromString(view)
+                finally:
+                    view.release()
+        return model_proto
+
     @staticmethod
     def generate_publisher(publisherargs):
         publisher = Publisher(author=publisherargs.author, email=publisherargs.email)
@@ -210,6 +276,12 @@ class ModelExportUtils(object):
         """
         arg_dict = vars(args)
 
+        # The manifest only depends on these arguments, so callers archiving in a loop reuse the serialized json
+        cache_key = tuple((k, arg_dict[k]) for k in MANIFEST_ARGS if k in arg_dict)
+        manifest_json = ModelExportUtils.manifest_cache.get(cache_key)
+        if manifest_json is not None:
+            return manifest_json
+
         publisher = ModelExportUtils.generate_publisher(args) if 'author' in arg_dict and 'email' in arg_dict else None
 
         engine = ModelExportUtils.generate_engine(args) if 'engine' in arg_dict else None
@@ -218,7 +290,11 @@ class ModelExportUtils(object):
 
         manifest = Manifest(runtime=args.runtime, model=model, engine=engine, publisher=publisher)
 
-        return str(manifest)
+        manifest_json = str(manifest)
+        if len(ModelExportUtils.manifest_cache) >= MANIFEST_CACHE_SIZE:
+            ModelExportUtils.manifest_cache.clear()
+        ModelExportUtils.manifest_cache[cache_key] = manifest_json
+        return manifest_json
 
     @staticmethod
     def clean_temp_files(temp_files):
@@ -226,50 +302,111 @@ class ModelExportUtils(object):
             os.remove(f)
 
     @staticmethod
-    def archive(export_file, model_name, model_path, files_to_exclude, manifest, archive_format="default"):
+    def archive(mar_path, model_name, model_path, files_to_exclude, manifest, archive_format="default",
+                compress_level=DEFAULT_COMPRESS_LEVEL):
         """
         Create a model-archive
+        :param compress_level:
         :param archive_format:
-        :param export_file:
+        :param mar_path: path of the model-archive file, as returned by check_mar_already_exists
         :param model_name:
         :param model_path:
         :param files_to_exclude:
         :param manifest:
         :return:
         """
-        mar_path = ModelExportUtils.get_archive_export_path(export_file, model_name, archive_format)
+        files_to_exclude = set(files_to_exclude)
+        files_to_exclude.add(MANIFEST_FILE_NAME)
         try:
             if archive_format == "default":
-                with zipfile.ZipFile(mar_path, 'w', zipfile.ZIP_DEFLATED) as z:
-                    ModelExportUtils.archive_dir(model_path, z, set(files_to_exclude), archive_format, model_name)
+                compression = zipfile.ZIP_STORED if compress_level == 0 else zipfile.ZIP_DEFLATED
+                with zipfile.ZipFile(mar_path, 'w', compression) as z:
+                    ModelExportUtils.archive_dir(model_path, z, files_to_exclude, archive_format, model_name,
+                                                 compress_level)
                     # Write the manifest here now as a json
                     z.writestr(os.path.join(MAR_INF, MANIFEST_FILE_NAME), manifest)
             elif archive_format == "tgz":
-                import tarfile
-                from io import BytesIO
-                with tarfile.open(mar_path, 'w:gz') as z:
-                    ModelExportUtils.archive_dir(model_path, z, set(files_to_exclude), archive_format, model_name)
-                    # Write the manifest here now as a json
-                    tar_manifest = tarfile.TarInfo(name=os.path.join(model_name, MAR_INF, MANIFEST_FILE_NAME))
-                    tar_manifest.size = len(manifest.encode('utf-8'))
-                    z.addfile(tarinfo=tar_manifest, fileobj=BytesIO(manifest.encode()))
-                    z.close()
+                ModelExportUtils.archive_tgz(mar_path, model_name, model_path, files_to_exclude, manifest,
+                                             compress_level)
             else:
                 logging.error("Unknown format %s", archive_format)
 
         except IOError:
-            logging.error("Failed to save the model-archive to model-path \"%s\". "
-                          "Check the file permissions and retry.", export_file)
+            logging.error("Failed to save the model-archive to \"%s\". "
+                          "Check the file permissions and retry.", mar_path)
             raise
         except:
             logging.error("Failed to convert %s to the model-archive.", model_name)
             raise
 
     @staticmethod
-    def archive_dir(path, dst, files_to_exclude, archive_format, model_name):
+    def archive_tgz(mar_path, model_name, model_path, files_to_exclude, manifest, compress_level):
+        """
+        Create a .tar.gz model-archive. The tar is written as a stream and gzipped by pigz across all cores
+        when it is installed, falling back to single threaded gzip otherwise.
+        :param mar_path:
+        :param model_name:
+        :param model_path:
+        :param files_to_exclude:
+        :param manifest:
+        :param compress_level:
+        :return:
+        """
+        import gzip
+        import subprocess
+
+        pigz = which('pigz')
+        with open(mar_path, 'wb') as out:
+            if pigz is not None:
+                proc = subprocess.Popen([pigz, '-c', '-{}'.format(compress_level)], stdin=subprocess.PIPE,
+                                        stdout=out)
+                try:
+                    try:
+                        ModelExportUtils.write_tar_stream(proc.stdin, model_name, model_path, files_to_exclude,
+                                                          manifest)
+                    finally:
+                        try:
+                            proc.stdin.close()
+                        except (IOError, OSError):
+                            # The pipe is broken if pigz died, a failure which its exit code reports
+                            pass
+                finally:
+                    returncode = proc.wait()
+                if returncode != 0:
+                    raise IOError("pigz failed with exit code {}".format(returncode))
+            else:
+                with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=compress_level) as gz:
+                    ModelExportUtils.write_tar_stream(gz, model_name, model_path, files_to_exclude, manifest)
+
+    @staticmethod
+    def write_tar_stream(fileobj, model_name, model_path, files_to_exclude, manifest):
+        """
+        Write the model files followed by the manifest as an uncompressed tar stream into fileobj
+        :param fileobj:
+        :param model_name:
+        :param model_path:
+        :param files_to_exclude:
+        :param manifest:
+        :return:
+        """
+        import tarfile
+        from io import BytesIO
+
+        with tarfile.open(fileobj=fileobj, mode='w|') as z:
+            ModelExportUtils.archive_dir(model_path, z, files_to_exclude, "tgz", model_name)
+            # Write the manifest here now as a json
+            tar_manifest = tarfile.TarInfo(name=os.path.join(model_name, MAR_INF, MANIFEST_FILE_NAME))
+            # On Python 2 the manifest is already the UTF-8 encoded str of a Manifest
+            manifest_bytes = manifest if isinstance(manifest, bytes) else manifest.encode('utf-8')
+            tar_manifest.size = len(manifest_bytes)
+            z.addfile(tarinfo=tar_manifest, fileobj=BytesIO(manifest_bytes))
+
+    @staticmethod
+    def archive_dir(path, dst, files_to_exclude, archive_format, model_name, compress_level=DEFAULT_COMPRESS_LEVEL):
 
         """
         This method zips the dir and filters out some files based on a expression
+        :param compress_level:
         :param archive_format:
         :param path:
         :param dst:
@@ -277,19 +414,261 @@ class ModelExportUtils(object):
         :param files_to_exclude:
         :return:
         """
-        unwanted_dirs = {'__MACOSX', '__pycache__'}
+        arcname_prefix = model_name + os.sep if archive_format == "tgz" else ''
+        files = ModelExportUtils.walk_model_dir(path, files_to_exclude, arcname_prefix)
+        if archive_format == "tgz":
+            for file_path, arcname in files:
+                dst.add(file_path, arcname=arcname)
+        elif compress_level == 0:
+            for file_path, arcname in files:
+                ModelExportUtils.write_zip_entry(dst, file_path, arcname)
+        else:
+            entries = [(file_path, arcname, compress_level) for file_path, arcname in files]
+            ModelExportUtils.write_zip_entries_in_parallel(dst, entries)
+
+    @staticmethod
+    def write_zip_entry(z, file_path, arcname):
+        """
+        Write a file into the zip archive. Large files are streamed in with a bigger buffer than the 8KB
+        ZipFile.write uses.
+        :param z:
+        :param file_path:
+        :param arcname:
+        :return:
+        """
+        if ZIP_OPEN_FOR_WRITE_SUPPORTED:
+            zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+            if zinfo.file_size >= LARGE_FILE_SIZE:
+                zinfo.compress_type = z.compression
+                with open(file_path, 'rb') as src, z.open(zinfo, 'w') as dst:
+                    shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+                return
+
+        z.write(file_path, arcname)
+
+    @staticmethod
+    def write_zip_entries_in_parallel(z, entries):
+        """
+        Deflate the files in a thread pool and write the compressed entries into the zip archive in order.
+        zlib releases the GIL while compressing, so threads scale with the number of cores without having to
+        pickle the file contents between processes. Only about one file per worker is compressed ahead of the
+        writer, and large files are only checksummed by the pool and deflated as they are written, so at most about
+        (workers + 1) * LARGE_FILE_SIZE of compressed data is held in memory however big the model files are.
+        :param z:
+        :param entries: list of (file_path, arcname, compress_level)
+        :return:
+        """
+        if not entries:
+            return
 
-        for root, directories, files in os.walk(path):
-            # Filter directories
-            directories[:] = [d for d in directories if ModelExportUtils.directory_filter(d, unwanted_dirs)]
-            # Filter files
-            files[:] = [f for f in files if ModelExportUtils.file_filter(f, files_to_exclude)]
-            for f in files:
-                file_path = os.path.join(root, f)
-                if archive_format == "tgz":
-                    dst.add(file_path, arcname=os.path.join(model_name, os.path.relpath(file_path, path)))
-                else:
-                    dst.write(file_path, os.path.relpath(file_path, path))
+        import multiprocessing
+        from collections import deque
+        from multiprocessing.pool import ThreadPool
+
+        workers = min(multiprocessing.cpu_count(), len(entries))
+        pool = ThreadPool(workers)
+        pending = deque()
+        try:
+            for entry in entries:
+                pending.append(pool.apply_async(ModelExportUtils.compress_zip_entry, (entry,)))
+                if len(pending) > workers:
+                    ModelExportUtils.write_compressed_zip_entry(z, *pending.popleft().get())
+            while pending:
+                ModelExportUtils.write_compressed_zip_entry(z, *pending.popleft().get())
+        except:
+            # Don't wait for the files still queued to be compressed
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+    @staticmethod
+    def compress_zip_entry(entry):
+        """
+        Read and raw-deflate a file, returning the ZipInfo describing it together with the compressed chunks.
+        Large files are memory mapped rather than read, so that crc32 runs over the whole file in a single call
+        without first copying it onto the heap. Their chunks are generated lazily from the file on the thread
+        writing them, so they are never held in memory as a whole, and their compress_size is left as None until
+        they are written. Files that would barely shrink are stored instead.
+        :param entry: tuple of (file_path, arcname, compress_level)
+        :return:
+        """
+        import mmap
+
+        file_path, arcname, compress_level = entry
+        st = os.stat(file_path)
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+
+        if st.st_size < LARGE_FILE_SIZE:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            if ModelExportUtils.is_incompressible(data, compress_level):
+                zinfo.compress_type = zipfile.ZIP_STORED
+                zinfo.file_size = zinfo.compress_size = len(data)
+                zinfo.CRC = zlib.crc32(data) & 0xffffffff
+                return zinfo, (data,)
+            return zinfo, ModelExportUtils.raw_deflate(zinfo, data, compress_level)
+
+        with open(file_path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                zinfo.file_size = len(data)
+                zinfo.CRC = zlib.crc32(data) & 0xffffffff
+                if ModelExportUtils.is_incompressible(data, compress_level):
+                    zinfo.compress_type = zipfile.ZIP_STORED
+                    zinfo.compress_size = zinfo.file_size
+                    return zinfo, ModelExportUtils.read_chunks(file_path)
+            finally:
+                data.close()
+        zinfo.compress_size = None
+        return zinfo, ModelExportUtils.raw_deflate_chunks(file_path, compress_level)
+
+    @staticmethod
+    def is_incompressible(data, compress_level):
+        """
+        Check whether deflating a file is not worth it, judged by how well its first INCOMPRESSIBLE_PROBE_SIZE bytes
+        deflate. Model parameters are dense floats which usually only shrink by a few percent.
+        :param data: bytes or any buffer, such as an mmap
+        :param compress_level:
+        :return:
+        """
+        if len(data) < INCOMPRESSIBLE_PROBE_SIZE:
+            return False
+
+        probe = data[:INCOMPRESSIBLE_PROBE_SIZE]
+        if compress_level >= HIGH_COMPRESS_LEVEL:
+            return len(zlib.compress(probe, compress_level)) >= len(probe)
+        return len(zlib.compress(probe, 1)) > INCOMPRESSIBLE_RATIO * len(probe)
+
+    @staticmethod
+    def read_chunks(file_path):
+        """
+        Generator over the contents of a file in COPY_BUFFER_SIZE chunks
+        :param file_path:
+        :return:
+        """
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+                yield chunk
+
+    @staticmethod
+    def raw_deflate_chunks(file_path, compress_level):
+        """
+        Generator raw-deflating a file from a read-only memory map of it, COPY_BUFFER_SIZE bytes at a time, so that
+        only the compressed output of one slice is in memory at once
+        :param file_path:
+        :param compress_level:
+        :return:
+        """
+        import mmap
+        from contextlib import closing
+
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        with open(file_path, 'rb') as f, closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as m:
+            try:
+                view = memoryview(m)
+            except TypeError:  # Python 2.7 mmap does not export the buffer protocol, so slices of it are copies
+                view = m
+            try:
+                for offset in range(0, len(m), COPY_BUFFER_SIZE):
+                    chunk = compressor.compress(view[offset:offset + COPY_BUFFER_SIZE])
+                    if chunk:
+                        yield chunk
+            finally:
+                if view is not m:
+                    view.release()
+        yield compressor.flush()
+
+    @staticmethod
+    def raw_deflate(zinfo, data, compress_level):
+        """
+        Raw-deflate data in one zlib call and record its CRC and sizes on zinfo. The compressed chunks are kept
+        apart so a large compressed file is not copied again just to append the few bytes of the final flush.
+        :param zinfo:
+        :param data: bytes or any buffer, such as an mmap
+        :param compress_level:
+        :return: the compressed data, as a tuple of byte strings
+        """
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        chunks = (compressor.compress(data), compressor.flush())
+        zinfo.file_size = len(data)
+        zinfo.compress_size = sum(len(c) for c in chunks)
+        zinfo.CRC = zlib.crc32(data) & 0xffffffff
+        return chunks
+
+    @staticmethod
+    def write_compressed_zip_entry(z, zinfo, chunks):
+        """
+        Append an already compressed entry to the zip archive, bypassing the compression in ZipFile.write.
+        This relies on ZipFile internals which have been stable from Python 2.7 to 3.x, but are not a public API.
+        When the compressed size is not known up front, the local file header is rewritten once the chunks have been
+        written, as ZipFile.open does for seekable files.
+        :param z:
+        :param zinfo: ZipInfo with the compress_type, CRC and file_size set, and the compress_size or None
+        :param chunks: the compressed data, as an iterable of byte strings
+        :return:
+        """
+        streamed = zinfo.compress_size is None
+        # The size of the header depends on whether it has a zip64 extra field, so decide that up front the same
+        # way ZipFile.open does
+        zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT if streamed else None
+        # Python 2.7 has neither ZipFile._lock nor start_dir. Only the thread calling this writes to the archive.
+        lock = getattr(z, '_lock', None)
+        if lock is not None:
+            lock.acquire()
+        try:
+            if hasattr(z, 'start_dir'):
+                z.fp.seek(z.start_dir)
+            # Python 2.7 checks the header offset against the zip64 limit in _writecheck
+            zinfo.header_offset = z.fp.tell()
+            z._writecheck(zinfo)
+            z._didModify = True
+            if streamed:
+                zinfo.compress_size = 0
+            z.fp.write(zinfo.FileHeader(zip64))
+            compress_size = 0
+            for chunk in chunks:
+                z.fp.write(chunk)
+                compress_size += len(chunk)
+            if streamed:
+                zinfo.compress_size = compress_size
+                end = z.fp.tell()
+                z.fp.seek(zinfo.header_offset)
+                z.fp.write(zinfo.FileHeader(zip64))
+                z.fp.seek(end)
+            z.filelist.append(zinfo)
+            z.NameToInfo[zinfo.filename] = zinfo
+            # Python 3 tracks where the central directory starts separately from the file position
+            if hasattr(z, 'start_dir'):
+                z.start_dir = z.fp.tell()
+        finally:
+            if lock is not None:
+                lock.release()
+
+    @staticmethod
+    def walk_model_dir(path, files_to_exclude, arcname_prefix=''):
+        """
+        Generator over (file_path, arcname) for the files under path that go into the model archive.
+        Uses scandir so that the file type comes from the directory entry instead of an extra stat() per entry,
+        and builds the arcname from the names walked through instead of calling os.path.relpath per file.
+        :param path:
+        :param files_to_exclude:
+        :param arcname_prefix:
+        :return:
+        """
+        for entry in scandir(path):
+            if entry.is_dir():
+                # Like os.walk, symlinked directories are not descended into
+                if ModelExportUtils.directory_filter(entry.name, UNWANTED_DIRS) and not entry.is_symlink():
+                    for file_entry in ModelExportUtils.walk_model_dir(entry.path, files_to_exclude,
+                                                                      arcname_prefix + entry.name + os.sep):
+                        yield file_entry
+            elif ModelExportUtils.file_filter(entry.name, files_to_exclude):
+                yield entry.path, arcname_prefix + entry.name
 
     @staticmethod
     def directory_filter(directory, unwanted_dirs):
@@ -314,11 +693,10 @@ class ModelExportUtils(object):
         :param files_to_exclude:
         :return:
         """
-        files_to_exclude.add('MANIFEST.json')
         if current_file in files_to_exclude:
             return False
 
-        elif current_file.endswith(('.pyc', '.DS_Store', '.mar')):
+        elif current_file.endswith(EXCLUDED_FILE_SUFFIXES):
             return False
 
         return True
@@ -331,7 +709,7 @@ class ModelExportUtils(object):
         :param model_name:
         :return:
         """
-        if not re.match(r'^[A-Za-z0-9][A-Za-z0-9_\-.]*$', model_name):
+        if not MODEL_NAME_PATTERN.match(model_name):
             raise ModelArchiverError("Model name contains special characters.\n"
                                      "The allowed regular expression filter for model "
                                      "name is: ^[A-Za-z0-9][A-Za-z0-9_\\-.]*$")
@@ -0,0 +1,39 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import json
+
+import pytest
+
+from model_archiver import json_utils
+
+
+# noinspection PyClassHasNoInit
+class TestJsonUtils:
+
+    data = {'inputs': [{'data_name': 'data', 'data_shape': [1, 3, 224, 224]}], 'input_type': 'image/jpeg'}
+
+    @pytest.fixture(params=['orjson', 'json'])
+    def backend(self, request, mocker):
+        if request.param == 'json':
+            mocker.patch('model_archiver.json_utils.orjson', None)
+        elif json_utils.orjson is None:
+            pytest.skip('orjson is not installed')
+        return request.param
+
+    def test_round_trip(self, backend):
+        assert json_utils.loads(json_utils.dumps(self.data)) == self.data
+
+    def test_dumps_is_indented(self, backend):
+        assert json_utils.dumps(self.data) == json.dumps(self.data, indent=2)
+
+        non_ascii = {'publisher': {'author': u'Jos\u00e9 M\u00fcller', 'email': 'jm@example.com'}}
+        assert json_utils.dumps(non_ascii) == json.dumps(non_ascii, indent=2, ensure_ascii=False)
+        assert json_utils.loads(json_utils.dumps(non_ascii)) == non_ascii
@@ -38,7 +38,7 @@ class TestModelPackaging:
 
     args = Namespace(author=author, email=email, engine=engine, model_name=model_name, handler=handler,
                      runtime=RuntimeType.PYTHON.value, model_path=model_path, export_path=export_path, force=False,
-                     archive_format="default")
+                     archive_format="default", compress_level=1)
 
     @pytest.fixture()
     def patches(self, mocker):
@@ -55,7 +55,7 @@ class TestModelPackaging:
         patches.export_method.assert_called()
 
     def test_export_model_method(self, patches):
-        patches.export_utils.check_mar_already_exists.return_value = '/Users/dummyUser/'
+        patches.export_utils.check_mar_already_exists.return_value = '/Users/dummyUser/my-model.mar'
         patches.export_utils.check_custom_model_types.return_value = '/Users/dummyUser', ['a.txt', 'b.txt']
         patches.export_utils.zip.return_value = None
 
@@ -66,7 +66,7 @@ class TestModelPackaging:
 
     def test_export_model_method_tar(self, patches):
         self.args.update(archive_format="tar")
-        patches.export_utils.check_mar_already_exists.return_value = '/Users/dummyUser/'
+        patches.export_utils.check_mar_already_exists.return_value = '/Users/dummyUser/my-model.mar'
         patches.export_utils.check_custom_model_types.return_value = '/Users/dummyUser', ['a.txt', 'b.txt']
         patches.export_utils.zip.return_value = None
 
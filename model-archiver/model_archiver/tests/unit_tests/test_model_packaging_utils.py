@@ -8,8 +8,16 @@
 # express or implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import errno
 import json
 import os
+import struct
+import subprocess
+import sys
+import tarfile
+import types
+import zipfile
+import zlib
 import pytest
 from collections import namedtuple
 from model_archiver.model_packaging_utils import ModelExportUtils
@@ -26,47 +34,66 @@ class TestExportModelUtils:
 
         @pytest.fixture()
         def patches(self, mocker):
-            Patches = namedtuple('Patches', ['getcwd', 'path_exists'])
-            patches = Patches(mocker.patch('os.getcwd'), mocker.patch('os.path.exists'))
+            Patches = namedtuple('Patches', ['getcwd', 'stat', 'access'])
+            patches = Patches(mocker.patch('os.getcwd'), mocker.patch('os.stat'), mocker.patch('os.access'))
 
             patches.getcwd.return_value = '/Users/dummyUser'
+            patches.access.return_value = True
 
             return patches
 
+        @staticmethod
+        def not_found(patches):
+            patches.stat.side_effect = OSError(errno.ENOENT, 'No such file or directory')
+
+        @staticmethod
+        def assert_stat_called_once_with(patches, path):
+            # pytest itself stats files while os.stat is patched on Python 2.7
+            assert [c for c in patches.stat.call_args_list if c[0] == (path,)] == [((path,),)]
+
         def test_export_file_is_none(self, patches):
-            patches.path_exists.return_value = False
+            self.not_found(patches)
             ret_val = ModelExportUtils.check_mar_already_exists('some-model', None, False)
 
-            patches.path_exists.assert_called_once_with("/Users/dummyUser/some-model.mar")
-            assert ret_val == "/Users/dummyUser"
+            self.assert_stat_called_once_with(patches, "/Users/dummyUser/some-model.mar")
+            assert ret_val == "/Users/dummyUser/some-model.mar"
 
         def test_export_file_is_not_none(self, patches):
-            patches.path_exists.return_value = False
+            self.not_found(patches)
             ModelExportUtils.check_mar_already_exists('some-model', '/Users/dummyUser/', False)
 
-            patches.path_exists.assert_called_once_with('/Users/dummyUser/some-model.mar')
+            self.assert_stat_called_once_with(patches, '/Users/dummyUser/some-model.mar')
 
         def test_export_file_already_exists_with_override(self, patches):
-            patches.path_exists.return_value = True
-
             ModelExportUtils.check_mar_already_exists('some-model', None, True)
 
-            patches.path_exists.assert_called_once_with('/Users/dummyUser/some-model.mar')
+            self.assert_stat_called_once_with(patches, '/Users/dummyUser/some-model.mar')
+            patches.access.assert_called_once_with('/Users/dummyUser/some-model.mar', os.W_OK)
 
         def test_export_file_already_exists_with_override_false(self, patches):
-            patches.path_exists.return_value = True
-
             with pytest.raises(ModelArchiverError):
                 ModelExportUtils.check_mar_already_exists('some-model', None, False)
 
-            patches.path_exists.assert_called_once_with('/Users/dummyUser/some-model.mar')
+            self.assert_stat_called_once_with(patches, '/Users/dummyUser/some-model.mar')
+
+        def test_export_file_already_exists_not_writable(self, patches):
+            patches.access.return_value = False
+
+            with pytest.raises(ModelArchiverError):
+                ModelExportUtils.check_mar_already_exists('some-model', None, True)
+
+        def test_export_file_stat_error(self, patches):
+            patches.stat.side_effect = OSError(errno.EACCES, 'Permission denied')
+
+            with pytest.raises(OSError):
+                ModelExportUtils.check_mar_already_exists('some-model', None, False)
 
         def test_export_file_is_none_tar(self, patches):
-            patches.path_exists.return_value = False
+            self.not_found(patches)
             ret_val = ModelExportUtils.check_mar_already_exists('some-model', None, False, archive_format='tgz')
 
-            patches.path_exists.assert_called_once_with("/Users/dummyUser/some-model.tar.gz")
-            assert ret_val == "/Users/dummyUser"
+            self.assert_stat_called_once_with(patches, "/Users/dummyUser/some-model.tar.gz")
+            assert ret_val == "/Users/dummyUser/some-model.tar.gz"
 
 
     # noinspection PyClassHasNoInit
@@ -76,11 +103,11 @@ class TestExportModelUtils:
 
         @pytest.fixture()
         def patches(self, mocker):
-            Patches = namedtuple('Patches', ['utils', 'listdir'])
+            Patches = namedtuple('Patches', ['utils', 'scandir'])
             patch = Patches(mocker.patch('model_archiver.model_packaging_utils.ModelExportUtils'),
-                            mocker.patch('os.listdir'))
+                            mocker.patch('model_archiver.model_packaging_utils.scandir'))
 
-            patch.listdir.return_value = {'a', 'b', 'c'}
+            patch.scandir.return_value = []
             return patch
 
         def test_onnx_file_is_none(self, patches):
@@ -104,6 +131,39 @@ class TestExportModelUtils:
             assert temp[1] == os.path.join(self.model_path, 'param')
             assert exclude[0] == onnx_file
 
+        def test_onnx_file_scan_skips_hidden_files_and_dirs(self, tmpdir, mocker):
+            for name in ['model.onnx', '._model.onnx', 'signature.json', 'dir.onnx/a']:
+                tmpdir.join(name).ensure()
+            convert = mocker.patch.object(ModelExportUtils, 'convert_onnx_model', return_value=('sym', 'param'))
+
+            _, exclude = ModelExportUtils.check_custom_model_types(str(tmpdir), 'my-model')
+
+            convert.assert_called_once_with(str(tmpdir), 'model.onnx', 'my-model')
+            assert exclude == ['model.onnx']
+
+    # noinspection PyClassHasNoInit
+    class TestParseOnnxModel:
+
+        class ModelProto(object):
+            def __init__(self):
+                self.parsed = None
+
+            def ParseFromString(self, data):
+                # Copied, as the memory map behind data is closed once parsing is done
+                self.parsed = bytes(data)
+
+        def test_parses_the_file_contents(self, tmpdir, mocker):
+            onnx = types.ModuleType('onnx')
+            onnx.ModelProto = self.ModelProto
+            mocker.patch.dict(sys.modules, {'onnx': onnx})
+            contents = os.urandom(3 * 1024 * 1024 + 1)
+            tmpdir.join('model.onnx').write_binary(contents)
+
+            model_proto = ModelExportUtils.parse_onnx_model(str(tmpdir.join('model.onnx')))
+
+            assert isinstance(model_proto, self.ModelProto)
+            assert model_proto.parsed == contents
+
     # noinspection PyClassHasNoInit
     class TestFindUnique:
 
@@ -182,6 +242,38 @@ class TestExportModelUtils:
             assert 'publisher' in manifest_json
             assert 'license' not in manifest_json
 
+        @pytest.mark.parametrize('archive_format', ['default', 'tgz'])
+        def test_non_ascii_manifest_json(self, tmpdir, archive_format):
+            args = self.Namespace(author=u'Jos\u00e9 M\u00fcller', email=self.email, engine=self.engine,
+                                  model_name='non-ascii-model', handler=u'h\u00e4ndler.py',
+                                  runtime=RuntimeType.PYTHON.value)
+            manifest = ModelExportUtils.generate_manifest_json(args)
+            assert isinstance(manifest, str)
+            assert json.loads(manifest)['publisher']['author'] == u'Jos\u00e9 M\u00fcller'
+
+            tmpdir.join('model', 'service.py').write('', ensure=True)
+            mar_path = str(tmpdir.join('non-ascii-model.mar'))
+            ModelExportUtils.archive(mar_path, 'non-ascii-model', str(tmpdir.join('model')), [], manifest,
+                                     archive_format=archive_format)
+            if archive_format == 'tgz':
+                with tarfile.open(mar_path) as t:
+                    manifest_bytes = t.extractfile('non-ascii-model/MAR-INF/MANIFEST.json').read()
+            else:
+                with zipfile.ZipFile(mar_path) as z:
+                    manifest_bytes = z.read('MAR-INF/MANIFEST.json')
+            assert json.loads(manifest_bytes.decode('utf-8'))['model']['handler'] == u'h\u00e4ndler.py'
+
+        def test_manifest_json_is_cached_per_args(self):
+            manifest = ModelExportUtils.generate_manifest_json(self.args)
+            assert ModelExportUtils.generate_manifest_json(self.args) is manifest
+
+            other_args = self.Namespace(model_name='other-model', handler=self.handler,
+                                        runtime=RuntimeType.PYTHON.value)
+            other_manifest = json.loads(ModelExportUtils.generate_manifest_json(other_args))
+            assert other_manifest['model']['modelName'] == 'other-model'
+            assert 'engine' not in other_manifest
+            assert 'publisher' not in other_manifest
+
     # noinspection PyClassHasNoInit
     class TestModelNameRegEx:
 
@@ -192,7 +284,7 @@ class TestExportModelUtils:
 
         def test_regex_fail(self):
             model_names = ['abc%', '123$abc', 'abc!123', '@123', '(model', 'mdoel)',
-                           '12*model-a.model', '##.model', '-.model']
+                           '12*model-a.model', '##.model', '-.model', 'model\n']
             for m in model_names:
                 with pytest.raises(ModelArchiverError):
                     ModelExportUtils.check_model_name_regex_or_exit(m)
@@ -227,3 +319,256 @@ class TestExportModelUtils:
 
         def test_with_return_true(self):
             assert ModelExportUtils.directory_filter('my-model', self.unwanted_dirs) is True
+
+    # noinspection PyClassHasNoInit
+    class TestWalkModelDir:
+
+        @pytest.fixture()
+        def model_dir(self, tmpdir):
+            for name in ['service.py', 'service.pyc', 'model.onnx', 'MANIFEST.json', 'sub/synset.txt',
+                         '.git/config', '__pycache__/service.cpython-36.pyc', 'sub/__MACOSX/junk']:
+                tmpdir.join(name).ensure()
+            return str(tmpdir)
+
+        def test_walk_filters_files_and_dirs(self, model_dir):
+            files = ModelExportUtils.walk_model_dir(model_dir, {'model.onnx', 'MANIFEST.json'})
+            assert sorted(files) == [(os.path.join(model_dir, 'service.py'), 'service.py'),
+                                     (os.path.join(model_dir, 'sub', 'synset.txt'), os.path.join('sub', 'synset.txt'))]
+
+        def test_walk_with_arcname_prefix(self, model_dir):
+            files = ModelExportUtils.walk_model_dir(model_dir, {'model.onnx', 'MANIFEST.json'},
+                                                    'my-model' + os.sep)
+            assert sorted(arcname for _, arcname in files) == [os.path.join('my-model', 'service.py'),
+                                                               os.path.join('my-model', 'sub', 'synset.txt')]
+
+    # noinspection PyClassHasNoInit
+    class TestArchive:
+
+        manifest = '{"runtime": "python"}'
+
+        @pytest.fixture()
+        def model_dir(self, tmpdir):
+            model_dir = tmpdir.mkdir('model')
+            model_dir.join('service.py').write('def handle(data, context):\n    return data\n')
+            model_dir.join('MANIFEST.json').write('{}')
+            model_dir.join('model.onnx').write('onnx')
+            model_dir.join('sub', 'synset.txt').write('a\nb\nc\n', ensure=True)
+            return model_dir
+
+        def test_archive_default(self, tmpdir, model_dir):
+            mar_path = str(tmpdir.join('my-model.mar'))
+            ModelExportUtils.archive(mar_path, 'my-model', str(model_dir), ['model.onnx'], self.manifest)
+
+            with zipfile.ZipFile(mar_path) as z:
+                assert sorted(z.namelist()) == ['MAR-INF/MANIFEST.json', 'service.py', 'sub/synset.txt']
+                assert z.read('MAR-INF/MANIFEST.json').decode('utf-8') == self.manifest
+                assert z.read('sub/synset.txt') == b'a\nb\nc\n'
+                assert z.getinfo('sub/synset.txt').compress_type == zipfile.ZIP_DEFLATED
+                assert z.testzip() is None
+
+        def test_archive_without_compression(self, tmpdir, model_dir):
+            mar_path = str(tmpdir.join('my-model.mar'))
+            ModelExportUtils.archive(mar_path, 'my-model', str(model_dir), ['model.onnx'], self.manifest,
+                                     compress_level=0)
+
+            with zipfile.ZipFile(mar_path) as z:
+                assert all(i.compress_type == zipfile.ZIP_STORED for i in z.infolist())
+
+        def test_archive_large_file(self, tmpdir, model_dir):
+            mar_path = str(tmpdir.join('my-model.mar'))
+            params = os.urandom(2 * 1024 * 1024)
+            model_dir.join('my-model-0000.params').write_binary(params)
+            ModelExportUtils.archive(mar_path, 'my-model', str(model_dir), ['model.onnx'], self.manifest)
+
+            with zipfile.ZipFile(mar_path) as z:
+                assert z.testzip() is None
+                assert z.read('my-model-0000.params') == params
+                assert z.getinfo('my-model-0000.params').compress_type == zipfile.ZIP_STORED
+
+        def test_archive_incompressible_file(self, tmpdir, model_dir):
+            mar_path = str(tmpdir.join('my-model.mar'))
+            model_dir.join('random.bin').write_binary(os.urandom(128 * 1024))
+            model_dir.join('vocab.txt').write('word\n' * 1024 * 1024)
+            ModelExportUtils.archive(mar_path, 'my-model', str(model_dir), ['model.onnx'], self.manifest)
+
+            with zipfile.ZipFile(mar_path) as z:
+                assert z.testzip() is None
+                assert z.getinfo('random.bin').compress_type == zipfile.ZIP_STORED
+                assert z.getinfo('vocab.txt').compress_type == zipfile.ZIP_DEFLATED
+                assert z.read('vocab.txt') == b'word\n' * 1024 * 1024
+
+        def test_archive_compressible_params_file(self, tmpdir, model_dir):
+            mar_path = str(tmpdir.join('my-model.mar'))
+            params = b'\0' * 2 * 1024 * 1024
+            model_dir.join('my-model-0000.params').write_binary(params)
+            ModelExportUtils.archive(mar_path, 'my-model', str(model_dir), ['model.onnx'], self.manifest)
+
+            with zipfile.ZipFile(mar_path) as z:
+                assert z.testzip() is None
+                assert z.read('my-model-0000.params') == params
+                assert z.getinfo('my-model-0000.params').compress_type == zipfile.ZIP_DEFLATED
+
+        def test_archive_several_large_files(self, tmpdir, model_dir):
+            mar_path = str(tmpdir.join('my-model.mar'))
+            contents = {}
+            for i in range(4):
+                contents['my-model-000%d.params' % i] = (b'%d' % i) * 2 * 1024 * 1024
+                contents['synset%d.txt' % i] = (b'word%d\n' % i) * 1024
+            for name, data in contents.items():
+                model_dir.join(name).write_binary(data)
+            ModelExportUtils.archive(mar_path, 'my-model', str(model_dir), ['model.onnx'], self.manifest,
+                                     compress_level=6)
+
+            with zipfile.ZipFile(mar_path) as z:
+                assert z.testzip() is None
+                for name, data in contents.items():
+                    assert z.read(name) == data
+                    assert z.getinfo(name).compress_type == zipfile.ZIP_DEFLATED
+
+        @pytest.mark.parametrize('compress_level,compress_type', [(1, zipfile.ZIP_STORED),
+                                                                  (9, zipfile.ZIP_DEFLATED)])
+        def test_archive_barely_compressible_file(self, tmpdir, model_dir, compress_level, compress_type):
+            mar_path = str(tmpdir.join('my-model.mar'))
+            data = b''.join(os.urandom(950) + b'\0' * 50 for _ in range(128))
+            model_dir.join('weights.bin').write_binary(data)
+            ModelExportUtils.archive(mar_path, 'my-model', str(model_dir), ['model.onnx'], self.manifest,
+                                     compress_level=compress_level)
+
+            with zipfile.ZipFile(mar_path) as z:
+                assert z.testzip() is None
+                assert z.read('weights.bin') == data
+                assert z.getinfo('weights.bin').compress_type == compress_type
+
+        def test_archive_tgz(self, tmpdir, model_dir):
+            mar_path = str(tmpdir.join('my-model.tar.gz'))
+            ModelExportUtils.archive(mar_path, 'my-model', str(model_dir), ['model.onnx'], self.manifest,
+                                     archive_format='tgz')
+
+            with tarfile.open(mar_path) as t:
+                assert sorted(t.getnames()) == ['my-model/MAR-INF/MANIFEST.json', 'my-model/service.py',
+                                                'my-model/sub/synset.txt']
+                assert t.extractfile('my-model/MAR-INF/MANIFEST.json').read().decode('utf-8') == self.manifest
+
+        @pytest.mark.parametrize('model_size', [0, 4 * 1024 * 1024])
+        def test_archive_tgz_pigz_failure(self, tmpdir, model_dir, mocker, model_size):
+            # A pigz that exits straight away, either before or after the whole tar fitted into the pipe
+            mocker.patch('model_archiver.model_packaging_utils.which', return_value='/bin/false')
+            wait = mocker.spy(subprocess.Popen, 'wait')
+            model_dir.join('my-model-0000.params').write_binary(b'\0' * model_size)
+            mar_path = str(tmpdir.join('my-model.tar.gz'))
+
+            with pytest.raises(IOError):
+                ModelExportUtils.archive(mar_path, 'my-model', str(model_dir), ['model.onnx'], self.manifest,
+                                         archive_format='tgz')
+            assert wait.call_count == 1
+
+        def test_archive_tgz_pigz_broken_pipe_on_close(self, tmpdir, model_dir, mocker):
+            mocker.patch('model_archiver.model_packaging_utils.which', return_value='pigz')
+            popen = mocker.patch('subprocess.Popen')
+            popen.return_value.stdin.close.side_effect = IOError(errno.EPIPE, 'Broken pipe')
+            popen.return_value.wait.return_value = 1
+            mocker.patch.object(ModelExportUtils, 'write_tar_stream',
+                                side_effect=IOError(errno.EPIPE, 'Broken pipe while writing'))
+
+            with pytest.raises(IOError, match='while writing'):
+                ModelExportUtils.archive(str(tmpdir.join('my-model.tar.gz')), 'my-model', str(model_dir),
+                                         ['model.onnx'], self.manifest, archive_format='tgz')
+            popen.return_value.wait.assert_called_once_with()
+
+        def test_archive_tgz_without_pigz(self, tmpdir, model_dir, mocker):
+            mocker.patch('model_archiver.model_packaging_utils.which', return_value=None)
+            mar_path = str(tmpdir.join('my-model.tar.gz'))
+            ModelExportUtils.archive(mar_path, 'my-model', str(model_dir), ['model.onnx'], self.manifest,
+                                     archive_format='tgz')
+
+            with tarfile.open(mar_path) as t:
+                assert t.extractfile('my-model/sub/synset.txt').read() == b'a\nb\nc\n'
+
+        def test_archive_tgz_with_pigz(self, tmpdir, model_dir, mocker):
+            # gzip takes the same -c and -<level> flags as pigz
+            mocker.patch('model_archiver.model_packaging_utils.which', return_value='gzip')
+            mar_path = str(tmpdir.join('my-model.tar.gz'))
+            ModelExportUtils.archive(mar_path, 'my-model', str(model_dir), ['model.onnx'], self.manifest,
+                                     archive_format='tgz')
+
+            with tarfile.open(mar_path) as t:
+                assert t.extractfile('my-model/sub/synset.txt').read() == b'a\nb\nc\n'
+
+    # noinspection PyClassHasNoInit
+    class TestWriteZipEntriesInParallel:
+
+        entries = [('file%d' % i, 'file%d' % i, 1) for i in range(50)]
+
+        @pytest.fixture()
+        def patches(self, mocker):
+            Patches = namedtuple('Patches', ['cpu_count', 'compress', 'write'])
+            patches = Patches(mocker.patch('multiprocessing.cpu_count'),
+                              mocker.patch.object(ModelExportUtils, 'compress_zip_entry'),
+                              mocker.patch.object(ModelExportUtils, 'write_compressed_zip_entry'))
+
+            patches.cpu_count.return_value = 2
+            patches.compress.side_effect = lambda entry: (entry[1], ())
+            return patches
+
+        def test_entries_written_in_order(self, patches):
+            ModelExportUtils.write_zip_entries_in_parallel(None, self.entries)
+
+            assert [c[0][1] for c in patches.write.call_args_list] == [e[1] for e in self.entries]
+
+        def test_compression_stays_close_to_the_writer(self, patches):
+            patches.write.side_effect = IOError('disk full')
+
+            with pytest.raises(IOError):
+                ModelExportUtils.write_zip_entries_in_parallel(None, self.entries)
+
+            assert patches.compress.call_count <= 3
+
+    # noinspection PyClassHasNoInit
+    class TestWriteCompressedZipEntry:
+
+        @staticmethod
+        def unzip_test(mar_path):
+            with zipfile.ZipFile(mar_path) as z:
+                assert z.testzip() is None
+            try:
+                subprocess.check_output(['unzip', '-tq', mar_path])
+            except OSError:
+                pass  # unzip is not installed
+
+        def test_zip64_entry_count(self, tmpdir):
+            # More entries than the 16 bit count of the classic end of central directory record
+            mar_path = str(tmpdir.join('my-model.mar'))
+            chunks = (zlib.compress(b'a')[2:-4],)
+            # Python 2.7 does not allow zip64 by default
+            with zipfile.ZipFile(mar_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as z:
+                for i in range(zipfile.ZIP_FILECOUNT_LIMIT + 1):
+                    zinfo = zipfile.ZipInfo('f%d.txt' % i)
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                    zinfo.file_size = 1
+                    zinfo.compress_size = len(chunks[0])
+                    zinfo.CRC = zlib.crc32(b'a') & 0xffffffff
+                    ModelExportUtils.write_compressed_zip_entry(z, zinfo, chunks)
+                z.writestr('MAR-INF/MANIFEST.json', '{}')
+
+            self.unzip_test(mar_path)
+            with zipfile.ZipFile(mar_path) as z:
+                assert len(z.infolist()) == zipfile.ZIP_FILECOUNT_LIMIT + 2
+                assert z.read('f%d.txt' % zipfile.ZIP_FILECOUNT_LIMIT) == b'a'
+
+        def test_streamed_large_entry(self, tmpdir):
+            mar_path = str(tmpdir.join('my-model.mar'))
+            data = b'word\n' * 1024 * 1024
+            tmpdir.join('vocab.txt').write_binary(data)
+            zinfo, chunks = ModelExportUtils.compress_zip_entry((str(tmpdir.join('vocab.txt')), 'vocab.txt', 1))
+            assert zinfo.compress_size is None
+            with zipfile.ZipFile(mar_path, 'w', zipfile.ZIP_DEFLATED) as z:
+                ModelExportUtils.write_compressed_zip_entry(z, zinfo, chunks)
+                z.writestr('MAR-INF/MANIFEST.json', '{}')
+
+            self.unzip_test(mar_path)
+            with zipfile.ZipFile(mar_path) as z, open(mar_path, 'rb') as f:
+                assert z.read('vocab.txt') == data
+                # The sizes in the rewritten local file header match the central directory
+                header = f.read(zipfile.sizeFileHeader)
+                compress_size, file_size = struct.unpack('<LL', header[18:26])
+                assert (compress_size, file_size) == (z.getinfo('vocab.txt').compress_size, len(data))
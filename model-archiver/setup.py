@@ -55,7 +55,7 @@ def detect_model_archiver_version():
 
 if __name__ == '__main__':
     version = detect_model_archiver_version()
-    requirements = ['future', 'enum-compat']
+    requirements = ['future', 'enum-compat', 'scandir; python_version < "3.5"']
 
     setup(
         name='model-archiver',
@@ -74,7 +74,8 @@ if __name__ == '__main__':
             'mxnet-cu90mkl': ['mxnet-cu90mkl==1.3.1'],
             'mxnet-cu92mkl': ['mxnet-cu92mkl==1.3.1'],
             'mxnet': ['mxnet==1.3.1'],
-            'onnx': ['onnx==1.1.1']
+            'onnx': ['onnx==1.1.1'],
+            'orjson': ['orjson']
         },
         entry_points={
             'console_scripts': ['model-archiver=model_archiver.model_packaging:generate_model_archive']